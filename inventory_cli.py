@@ -10,7 +10,7 @@
 機能:
   - 品目登録/更新/削除
   - 入庫/出庫の登録 (取引履歴を保持)
-  - 在庫数の参照 (集計)
+  - 在庫数の参照 (items.qty に現在庫を保持)
   - 品目一覧・検索
   - CSVインポート(品目) / エクスポート(現在庫)
   - しきい値(最小在庫)アラート
@@ -25,25 +25,37 @@
   python inventory_cli.py history --sku A-001 --limit 20
   python inventory_cli.py export-csv stocks.csv
   python inventory_cli.py import-items items.csv
+  python inventory_cli.py batch commands.txt
 
 CSVフォーマット:
   import-items: ヘッダ行あり -> sku,name,unit,min_qty
   export-csv:   現在庫 -> sku,name,unit,qty,min_qty,below_min(bool)
 
+バッチファイル:
+  1行に1コマンド (例: "in --sku A-001 --qty 10")。空行と # 以降は無視。
+  1つの接続を使い回して順に実行し、エラーが出た時点で行番号を表示して中断する
+  (それより前の行の結果は反映済み)。
+
+旧バージョンのDBからの移行:
+  どのコマンドでも接続時に自動で移行する (init の再実行は不要)。
+  items / stock_moves を現行の定義 (qty 列・CHECK 制約つき) で作り直し、qty は履歴の合計で埋める。
+  その際、負の min_qty は 0 にし、数量0の履歴と削除済み品目の履歴は捨てる。
+
 注意:
   - 出庫は在庫マイナスを禁止(デフォルト)。--allow-negative で許可可能。
+  - min_qty >= 0 と 数量0の入出庫禁止は DB の CHECK 制約でも保証する。
 """
 
 from __future__ import annotations
 import argparse
 import csv
 import os
+import shlex
 import sqlite3
 import sys
-from contextlib import closing
+from contextlib import closing, contextmanager
 from dataclasses import dataclass
-from datetime import datetime
-from typing import Iterable, Optional, Tuple
+from typing import Iterable, Iterator, List, Optional, Tuple
 
 DB_PATH = os.environ.get("INVENTORY_DB", "inventory.db")
 
@@ -51,46 +63,220 @@ DB_PATH = os.environ.get("INVENTORY_DB", "inventory.db")
 # DB Utilities
 # -----------------------------
 
-SCHEMA_SQL = """
-PRAGMA foreign_keys = ON;
-
-CREATE TABLE IF NOT EXISTS items (
+# テーブル定義 ({table} は移行時の作り直しで items_new などに置き換える)
+ITEMS_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS {table} (
     id          INTEGER PRIMARY KEY AUTOINCREMENT,
     sku         TEXT NOT NULL UNIQUE,
     name        TEXT NOT NULL,
     unit        TEXT NOT NULL DEFAULT 'pcs',
-    min_qty     INTEGER NOT NULL DEFAULT 0,
+    min_qty     INTEGER NOT NULL DEFAULT 0 CHECK (min_qty >= 0),
+    qty         INTEGER NOT NULL DEFAULT 0, -- 現在庫 (stock_moves の合計を add_move で維持)
     created_at  TEXT NOT NULL DEFAULT (datetime('now')),
     updated_at  TEXT NOT NULL DEFAULT (datetime('now'))
-);
+)"""
 
-CREATE TABLE IF NOT EXISTS stock_moves (
+STOCK_MOVES_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS {table} (
     id          INTEGER PRIMARY KEY AUTOINCREMENT,
     item_id     INTEGER NOT NULL,
-    change_qty  INTEGER NOT NULL, -- 入庫:+, 出庫:-
+    change_qty  INTEGER NOT NULL CHECK (change_qty <> 0), -- 入庫:+, 出庫:-
     reason      TEXT,
     ref         TEXT,
     at          TEXT NOT NULL DEFAULT (datetime('now')),
     FOREIGN KEY(item_id) REFERENCES items(id) ON DELETE CASCADE
-);
+)"""
+
+# 高速化用インデックス (items.sku は UNIQUE 制約の自動インデックスを使う)
+# 履歴表示 (item_id 指定, at/id 降順) を表参照なしで返すカバリングインデックス
+HISTORY_INDEX_SQL = (
+    "CREATE INDEX IF NOT EXISTS idx_moves_hist ON stock_moves(item_id, at DESC, id DESC, change_qty, reason, ref)"
+)
 
--- 高速化用インデックス
-CREATE INDEX IF NOT EXISTS idx_items_sku ON items(sku);
-CREATE INDEX IF NOT EXISTS idx_moves_item_id_at ON stock_moves(item_id, at);
+SCHEMA_SQL = f"""
+PRAGMA foreign_keys = ON;
+{ITEMS_TABLE_SQL.format(table="items")};
+{STOCK_MOVES_TABLE_SQL.format(table="stock_moves")};
+{HISTORY_INDEX_SQL};
+"""
+
+# 旧スキーマ (CHECK 制約なし) の2表を作り直す。SQLite は ALTER TABLE で制約を追加できないため、
+# 新しい表へ写して入れ替える。制約に反する行は直し (min_qty<0 は 0)、数量0や品目のない履歴は捨てる。
+# qty は stock_moves から計算し直す。旧インデックスは旧表と一緒に消える。id のカウンタは引き継ぐ
+REBUILD_TABLES_SQL = (
+    ITEMS_TABLE_SQL.format(table="items_new"),
+    """
+    INSERT INTO items_new (id, sku, name, unit, min_qty, qty, created_at, updated_at)
+    SELECT i.id, i.sku, i.name, i.unit, max(i.min_qty, 0),
+           (SELECT COALESCE(SUM(m.change_qty), 0) FROM stock_moves m WHERE m.item_id = i.id),
+           i.created_at, i.updated_at
+    FROM items i
+    """,
+    STOCK_MOVES_TABLE_SQL.format(table="stock_moves_new"),
+    """
+    INSERT INTO stock_moves_new (id, item_id, change_qty, reason, ref, at)
+    SELECT id, item_id, change_qty, reason, ref, at FROM stock_moves
+    WHERE change_qty <> 0 AND item_id IN (SELECT id FROM items)
+    """,
+    # 旧表の AUTOINCREMENT カウンタを引き継ぐ (削除済みの id を再発行しない)
+    *(sql.format(old=old) for old in ("items", "stock_moves") for sql in (
+        """
+        INSERT INTO sqlite_sequence (name, seq)
+        SELECT '{old}_new', seq FROM sqlite_sequence
+        WHERE name = '{old}' AND NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = '{old}_new')
+        """,
+        """
+        UPDATE sqlite_sequence SET seq = max(seq, (SELECT seq FROM sqlite_sequence WHERE name = '{old}'))
+        WHERE name = '{old}_new' AND EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = '{old}')
+        """,
+    )),
+    "DROP TABLE stock_moves",
+    "DROP TABLE items",
+    "ALTER TABLE items_new RENAME TO items",
+    "ALTER TABLE stock_moves_new RENAME TO stock_moves",
+    HISTORY_INDEX_SQL,
+)
+
+# 品目の一括登録/更新 (CSVインポート用)
+UPSERT_ITEM_SQL = """
+INSERT INTO items (sku, name, unit, min_qty) VALUES (?, ?, ?, ?)
+ON CONFLICT(sku) DO UPDATE SET
+    name = excluded.name,
+    unit = excluded.unit,
+    min_qty = excluded.min_qty,
+    updated_at = datetime('now')
 """
 
+# str.strip() が取り除く空白文字 (全角スペースを含む)。SQL 版の trim() で同じ結果にするために使う
+CSV_WHITESPACE = (
+    "\t\n\v\f\r\x1c\x1d\x1e\x1f \x85\xa0\u1680"
+    "\u2000\u2001\u2002\u2003\u2004\u2005\u2006\u2007\u2008\u2009\u200a"
+    "\u2028\u2029\u202f\u205f\u3000"
+)
+CSV_REQUIRED_COLUMNS = {"sku", "name", "unit", "min_qty"}
+
+# csv 仮想テーブル temp.csv_in を1回だけ読み、空白を除いた値を temp.csv_rows に置く
+STAGE_CSV_TABLE_SQL = """
+CREATE TEMP TABLE csv_rows AS
+SELECT trim(COALESCE(sku, ''), :ws) AS sku,
+       trim(COALESCE(name, ''), :ws) AS name,
+       trim(COALESCE(unit, ''), :ws) AS unit,
+       COALESCE(min_qty, '') AS min_qty_raw,
+       trim(COALESCE(min_qty, ''), :ws) AS min_qty
+FROM temp.csv_in
+"""
+
+# SQL だけでは import_items_csv_python と同じ結果にできない行があれば 1 を返す。
+# 全列が空の行 (csv.DictReader は空行を飛ばす)、空白だけの min_qty (int() はエラー)、
+# 符号+半角数字18桁以内でない min_qty (全角数字や 1_000 など int() に任せるもの) が対象
+CSV_NEEDS_PYTHON_SQL = """
+SELECT 1 FROM (
+    SELECT sku, name, unit, min_qty_raw, min_qty,
+           CASE WHEN substr(min_qty, 1, 1) IN ('+', '-') THEN substr(min_qty, 2) ELSE min_qty END AS digits
+    FROM temp.csv_rows
+)
+WHERE sku || name || unit || min_qty = ''
+   OR (min_qty_raw <> '' AND min_qty = '')
+   OR (min_qty <> '' AND (digits = '' OR length(digits) > 18 OR digits GLOB '*[^0-9]*'))
+LIMIT 1
+"""
+
+# 検証済みの temp.csv_rows から1文で登録/更新する
+IMPORT_ITEMS_FROM_CSV_TABLE_SQL = """
+INSERT INTO items (sku, name, unit, min_qty)
+SELECT sku, name, COALESCE(NULLIF(unit, ''), 'pcs'), CAST(COALESCE(NULLIF(min_qty, ''), '0') AS INTEGER)
+FROM temp.csv_rows
+WHERE true
+ON CONFLICT(sku) DO UPDATE SET
+    name = excluded.name,
+    unit = excluded.unit,
+    min_qty = excluded.min_qty,
+    updated_at = datetime('now')
+"""
+
+# CSVインポート (Python 版) で executemany にまとめる行数
+IMPORT_BATCH_SIZE = 5000
+
+# SQLite の csv 仮想テーブル拡張 (ext/misc/csv.c をビルドしたもの) のパス/名前
+CSV_EXTENSION = os.environ.get("INVENTORY_SQLITE_CSV_EXT", "csv")
+
+# sqlite3 モジュールのプリペアドステートメントキャッシュ (既定 128)
+STATEMENT_CACHE_SIZE = 256
+
+# 接続ごとに適用するチューニング (journal_mode は別途 WAL 化)
+CONNECTION_PRAGMAS = (
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -65536",      # 約64MiB
+    "PRAGMA mmap_size = 268435456",    # 256MiB
+    "PRAGMA foreign_keys = ON",
+)
 
-def connect(db_path: str = DB_PATH) -> sqlite3.Connection:
-    conn = sqlite3.connect(db_path)
+
+def connect(db_path: str = DB_PATH, check_same_thread: bool = True) -> sqlite3.Connection:
+    conn = sqlite3.connect(db_path, check_same_thread=check_same_thread, cached_statements=STATEMENT_CACHE_SIZE)
     conn.row_factory = sqlite3.Row
+    # WAL はDBファイルに永続化されるので、未設定のときだけ切り替える
+    mode = conn.execute("PRAGMA journal_mode").fetchone()[0]
+    if mode.lower() != "wal":
+        conn.execute("PRAGMA journal_mode = WAL")
+    for pragma in CONNECTION_PRAGMAS:
+        conn.execute(pragma)
+    migrate_db(conn)
     return conn
 
 
-def init_db() -> None:
-    with closing(connect()) as conn, conn:
+@contextmanager
+def open_conn(conn: Optional[sqlite3.Connection] = None) -> Iterator[sqlite3.Connection]:
+    """conn が渡されればそれを使い (閉じない)、なければ新規に接続して終了時に閉じる"""
+    if conn is not None:
+        yield conn
+        return
+    with closing(connect()) as own:
+        yield own
+
+
+def init_db(conn: Optional[sqlite3.Connection] = None) -> None:
+    with open_conn(conn) as conn, conn:
         conn.executescript(SCHEMA_SQL)
 
 
+def migrate_db(conn: sqlite3.Connection) -> None:
+    """旧スキーマのDBを現行スキーマへ移行する (connect() から毎回呼ばれる)
+
+    未初期化のDBや移行済みのDBでは sqlite_master を1回読むだけで何もしない。
+    """
+    if not needs_rebuild(conn):
+        return
+    # 表の入れ替え中に外部キーが働かないよう、トランザクションの外で無効にする
+    conn.execute("PRAGMA foreign_keys = OFF")
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if needs_rebuild(conn):  # 他のプロセスが先に移行していないか、ロック取得後に再確認
+                for sql in REBUILD_TABLES_SQL:
+                    conn.execute(sql)
+                if conn.execute("PRAGMA foreign_key_check").fetchone():
+                    raise sqlite3.IntegrityError("移行後のDBに外部キー違反があります")
+        except Exception:
+            conn.rollback()
+            raise
+        conn.commit()
+    finally:
+        conn.execute("PRAGMA foreign_keys = ON")
+
+
+def needs_rebuild(conn: sqlite3.Connection) -> bool:
+    """items/stock_moves が CHECK 制約のない旧定義のままなら True (未初期化なら False)"""
+    tables = {r["name"]: r["sql"] for r in conn.execute(
+        "SELECT name, sql FROM sqlite_master WHERE type = 'table' AND name IN ('items', 'stock_moves')"
+    )}
+    if "items" not in tables:
+        return False
+    return ("CHECK (min_qty >= 0)" not in tables["items"]
+            or "CHECK (change_qty <> 0)" not in tables.get("stock_moves", ""))
+
+
 # -----------------------------
 # Data Access Layer
 # -----------------------------
@@ -102,100 +288,141 @@ class Item:
     name: str
     unit: str
     min_qty: int
+    qty: int = 0  # 取得時点の現在庫 (items.qty)
+
+
+# Item のフィールド順に並べた items の列 (Item(*row) で組み立てる)
+ITEM_COLUMNS = "id, sku, name, unit, min_qty, qty"
+
+# DAL で使う SQL (文字列を使い回して sqlite3 のステートメントキャッシュに載せる)
+GET_ITEM_BY_SKU_SQL = f"SELECT {ITEM_COLUMNS} FROM items WHERE sku = ?"
+LIST_ITEMS_SQL = f"SELECT {ITEM_COLUMNS} FROM items ORDER BY sku"
+UPSERT_ITEM_RETURNING_SQL = f"{UPSERT_ITEM_SQL}RETURNING {ITEM_COLUMNS}"
+# RETURNING 句は SQLite 3.35 以降
+HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+INSERT_ITEM_SQL = "INSERT INTO items (sku, name, unit, min_qty) VALUES (?, ?, ?, ?)"
+UPDATE_ITEM_SQL = "UPDATE items SET name = ?, unit = ?, min_qty = ?, updated_at = datetime('now') WHERE sku = ?"
+DELETE_ITEM_SQL = "DELETE FROM items WHERE sku = ?"
+GET_STOCK_SQL = "SELECT qty FROM items WHERE id = ?"
+ADD_STOCK_SQL = "UPDATE items SET qty = qty + ? WHERE id = ?"
+# at 省略時はローカル時刻を SQLite 側で付与する
+INSERT_MOVE_SQL = (
+    "INSERT INTO stock_moves (item_id, change_qty, reason, ref, at) "
+    "VALUES (?, ?, ?, ?, COALESCE(?, datetime('now', 'localtime')))"
+)
+# export-csv の1行 (sku,name,unit,qty,min_qty,below_min) をそのまま返す
+EXPORT_STOCKS_SQL = """
+SELECT sku, name, unit, qty, min_qty, CASE WHEN qty < min_qty THEN 'true' ELSE 'false' END AS below_min
+FROM items
+ORDER BY sku
+"""
+HISTORY_BY_SKU_SQL = """
+SELECT i.name, m.at, m.change_qty, m.reason, m.ref
+FROM items i
+JOIN stock_moves m ON m.item_id = i.id
+WHERE i.sku = ?
+ORDER BY m.at DESC, m.id DESC
+LIMIT ?
+"""
 
 
 def get_item_by_sku(conn: sqlite3.Connection, sku: str) -> Optional[Item]:
-    row = conn.execute("SELECT * FROM items WHERE sku = ?", (sku,)).fetchone()
+    row = conn.execute(GET_ITEM_BY_SKU_SQL, (sku,)).fetchone()
     if not row:
         return None
-    return Item(id=row["id"], sku=row["sku"], name=row["name"], unit=row["unit"], min_qty=row["min_qty"])
+    return Item(*row)
 
 
 def upsert_item(conn: sqlite3.Connection, sku: str, name: str, unit: str, min_qty: int) -> Item:
+    if HAS_RETURNING:
+        return Item(*conn.execute(UPSERT_ITEM_RETURNING_SQL, (sku, name, unit, min_qty)).fetchone())
     existing = get_item_by_sku(conn, sku)
     if existing:
-        conn.execute(
-            "UPDATE items SET name = ?, unit = ?, min_qty = ?, updated_at = datetime('now') WHERE sku = ?",
-            (name, unit, min_qty, sku),
-        )
+        conn.execute(UPDATE_ITEM_SQL, (name, unit, min_qty, sku))
         item = get_item_by_sku(conn, sku)
         assert item is not None
         return item
     else:
-        cur = conn.execute(
-            "INSERT INTO items (sku, name, unit, min_qty) VALUES (?, ?, ?, ?)",
-            (sku, name, unit, min_qty),
-        )
+        cur = conn.execute(INSERT_ITEM_SQL, (sku, name, unit, min_qty))
         item_id = cur.lastrowid
         return Item(id=item_id, sku=sku, name=name, unit=unit, min_qty=min_qty)
 
 
 def delete_item(conn: sqlite3.Connection, sku: str) -> bool:
-    with conn:
-        res = conn.execute("DELETE FROM items WHERE sku = ?", (sku,))
-        return res.rowcount > 0
+    """コミットは呼び出し側で行う"""
+    return conn.execute(DELETE_ITEM_SQL, (sku,)).rowcount > 0
 
 
 def add_move(conn: sqlite3.Connection, item: Item, change_qty: int, reason: str = "", ref: str = "", at: Optional[str] = None) -> int:
-    at = at or datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    cur = conn.execute(
-        "INSERT INTO stock_moves (item_id, change_qty, reason, ref, at) VALUES (?, ?, ?, ?, ?)",
-        (item.id, change_qty, reason, ref, at),
-    )
+    """履歴の追加と items.qty の更新を同一トランザクションで行う (コミットは呼び出し側)
+
+    item.qty も更新後の現在庫に合わせるので、呼び出し側で再取得は不要。
+    """
+    cur = conn.execute(INSERT_MOVE_SQL, (item.id, change_qty, reason, ref, at or None))
+    conn.execute(ADD_STOCK_SQL, (change_qty, item.id))
+    item.qty += change_qty
     return cur.lastrowid
 
 
 def get_stock(conn: sqlite3.Connection, item: Item) -> int:
-    row = conn.execute("SELECT COALESCE(SUM(change_qty), 0) AS qty FROM stock_moves WHERE item_id = ?", (item.id,)).fetchone()
+    row = conn.execute(GET_STOCK_SQL, (item.id,)).fetchone()
     return int(row["qty"]) if row else 0
 
 
 def list_items_with_stock(conn: sqlite3.Connection) -> Iterable[Tuple[Item, int]]:
-    rows = conn.execute(
-        """
-        SELECT i.*, COALESCE(SUM(m.change_qty), 0) AS qty
-        FROM items i
-        LEFT JOIN stock_moves m ON m.item_id = i.id
-        GROUP BY i.id
-        ORDER BY i.sku
-        """
-    ).fetchall()
+    rows = conn.execute(LIST_ITEMS_SQL).fetchall()
     for r in rows:
-        yield Item(id=r["id"], sku=r["sku"], name=r["name"], unit=r["unit"], min_qty=r["min_qty"]), int(r["qty"]) 
+        item = Item(*r)
+        yield item, item.qty
+
+
+def list_items_with_stock_for_export(conn: sqlite3.Connection) -> sqlite3.Cursor:
+    """CSV出力用に、列順そのままのタプルを返すカーソル"""
+    cur = conn.cursor()
+    cur.row_factory = None
+    return cur.execute(EXPORT_STOCKS_SQL)
 
 
-def iter_history(conn: sqlite3.Connection, item: Item, limit: int = 50) -> Iterable[sqlite3.Row]:
-    rows = conn.execute(
-        "SELECT * FROM stock_moves WHERE item_id = ? ORDER BY at DESC, id DESC LIMIT ?",
-        (item.id, limit),
-    ).fetchall()
-    return rows
+def history_by_sku(conn: sqlite3.Connection, sku: str, limit: int = 50) -> Tuple[Optional[str], List[sqlite3.Row]]:
+    """(品目名, 履歴行) を返す。SKU が存在しなければ (None, [])
+
+    品目名と履歴を1回のJOINで取得し、履歴が空のときだけ品目の有無を確認する。
+    """
+    rows = conn.execute(HISTORY_BY_SKU_SQL, (sku, limit)).fetchall()
+    if rows:
+        return rows[0]["name"], rows
+    item = get_item_by_sku(conn, sku)
+    return (item.name if item else None), []
 
 # -----------------------------
 # Business Logic
 # -----------------------------
 
 def ensure_stock_for_out(conn: sqlite3.Connection, item: Item, qty: int, allow_negative: bool = False) -> None:
-    current = get_stock(conn, item)
+    """item は同じトランザクション内で取得したものを渡す (item.qty を現在庫として使う)"""
+    current = item.qty
     if not allow_negative and current - qty < 0:
         raise ValueError(f"在庫不足: SKU={item.sku} 現在庫={current} 要求出庫={qty}")
 
 
-def register_in(conn: sqlite3.Connection, sku: str, qty: int, reason: str = "", ref: str = "") -> int:
-    if qty <= 0:
-        raise ValueError("入庫数量は正の整数で指定してください")
+def find_item(conn: sqlite3.Connection, sku: str) -> Item:
     item = get_item_by_sku(conn, sku)
     if not item:
         raise KeyError(f"SKUが存在しません: {sku}")
+    return item
+
+
+def register_in(conn: sqlite3.Connection, item: Item, qty: int, reason: str = "", ref: str = "") -> int:
+    # 符号の向きは Python 側で確認する (DB の CHECK は 0 のみ弾く)
+    if qty <= 0:
+        raise ValueError("入庫数量は正の整数で指定してください")
     return add_move(conn, item, change_qty=qty, reason=reason or "入庫", ref=ref)
 
 
-def register_out(conn: sqlite3.Connection, sku: str, qty: int, reason: str = "", ref: str = "", allow_negative: bool = False) -> int:
+def register_out(conn: sqlite3.Connection, item: Item, qty: int, reason: str = "", ref: str = "", allow_negative: bool = False) -> int:
+    # 符号の向きは Python 側で確認する (DB の CHECK は 0 のみ弾く)
     if qty <= 0:
         raise ValueError("出庫数量は正の整数で指定してください")
-    item = get_item_by_sku(conn, sku)
-    if not item:
-        raise KeyError(f"SKUが存在しません: {sku}")
     ensure_stock_for_out(conn, item, qty, allow_negative)
     return add_move(conn, item, change_qty=-qty, reason=reason or "出庫", ref=ref)
 
@@ -204,44 +431,120 @@ def register_out(conn: sqlite3.Connection, sku: str, qty: int, reason: str = "",
 # CSV I/O
 # -----------------------------
 
+def load_csv_extension(conn: sqlite3.Connection) -> bool:
+    """csv 仮想テーブル拡張を読み込む。拡張の読み込みに対応しない環境では False"""
+    if not hasattr(conn, "enable_load_extension"):
+        return False
+    try:
+        conn.enable_load_extension(True)
+        try:
+            conn.load_extension(CSV_EXTENSION)
+        finally:
+            conn.enable_load_extension(False)
+    except sqlite3.OperationalError:
+        return False
+    return True
+
+
 def import_items_csv(conn: sqlite3.Connection, path: str) -> int:
-    """ヘッダ: sku,name,unit,min_qty"""
+    """ヘッダ: sku,name,unit,min_qty
+
+    csv 拡張が使えれば SQLite 内で直接取り込み、使えないか SQL で扱えない行があれば
+    Python で読み込む。
+    """
+    if load_csv_extension(conn):
+        count = import_items_csv_native(conn, path)
+        if count is not None:
+            return count
+    return import_items_csv_python(conn, path)
+
+
+def import_items_csv_native(conn: sqlite3.Connection, path: str) -> Optional[int]:
+    """csv 仮想テーブル経由で、CSV を SQLite 内で読んで登録/更新する"""
+    filename = "'" + path.replace("'", "''") + "'"
+    conn.execute(f"CREATE VIRTUAL TABLE temp.csv_in USING csv(filename={filename}, header=YES)")
+    try:
+        return import_items_from_csv_table(conn)
+    finally:
+        conn.execute("DROP TABLE IF EXISTS temp.csv_in")
+
+
+def import_items_from_csv_table(conn: sqlite3.Connection) -> Optional[int]:
+    """temp.csv_in (列 sku,name,unit,min_qty) の内容を import_items_csv_python と同じ規則で取り込む
+
+    CSV の読み込みは temp.csv_rows への1回だけで、判定と INSERT はその一時表に対して行う。
+    SQL で同じ結果にできない行があれば何も変更せずに None を返す (呼び出し側で Python 版に切り替える)。
+    """
+    columns = {r["name"] for r in conn.execute("PRAGMA temp.table_info(csv_in)")}
+    if not CSV_REQUIRED_COLUMNS <= columns:
+        raise ValueError(f"CSVヘッダが不足しています。必要: {CSV_REQUIRED_COLUMNS}")
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute(STAGE_CSV_TABLE_SQL, {"ws": CSV_WHITESPACE})
+        if conn.execute(CSV_NEEDS_PYTHON_SQL).fetchone():
+            conn.rollback()
+            return None
+        before = conn.total_changes
+        conn.execute(IMPORT_ITEMS_FROM_CSV_TABLE_SQL)
+        count = conn.total_changes - before
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.execute("DROP TABLE IF EXISTS temp.csv_rows")
+    conn.commit()
+    return count
+
+
+def import_items_csv_python(conn: sqlite3.Connection, path: str) -> int:
+    """IMPORT_BATCH_SIZE 行ずつ executemany し、全体を1トランザクションで登録/更新する"""
     count = 0
-    with open(path, newline='', encoding='utf-8') as f, conn:
+    batch: List[Tuple[str, str, str, int]] = []
+    with open(path, newline='', encoding='utf-8') as f:
         reader = csv.DictReader(f)
-        required = {"sku", "name", "unit", "min_qty"}
-        if set(reader.fieldnames or []) < required:
-            raise ValueError(f"CSVヘッダが不足しています。必要: {required}")
-        for row in reader:
-            sku = row["sku"].strip()
-            name = row["name"].strip()
-            unit = (row.get("unit") or "pcs").strip() or "pcs"
-            try:
-                min_qty = int(row.get("min_qty") or 0)
-            except Exception:
-                raise ValueError(f"min_qty が整数ではありません (sku={sku}): {row.get('min_qty')}")
-            upsert_item(conn, sku, name, unit, min_qty)
-            count += 1
+        if not CSV_REQUIRED_COLUMNS <= set(reader.fieldnames or []):
+            raise ValueError(f"CSVヘッダが不足しています。必要: {CSV_REQUIRED_COLUMNS}")
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for row in reader:
+                sku = (row["sku"] or "").strip()
+                name = (row["name"] or "").strip()
+                unit = (row.get("unit") or "pcs").strip() or "pcs"
+                try:
+                    min_qty = int(row.get("min_qty") or 0)
+                except Exception:
+                    raise ValueError(f"min_qty が整数ではありません (sku={sku}): {row.get('min_qty')}")
+                batch.append((sku, name, unit, min_qty))
+                if len(batch) >= IMPORT_BATCH_SIZE:
+                    conn.executemany(UPSERT_ITEM_SQL, batch)
+                    count += len(batch)
+                    batch.clear()
+            if batch:
+                conn.executemany(UPSERT_ITEM_SQL, batch)
+                count += len(batch)
+        except Exception:
+            conn.rollback()
+            raise
+    conn.commit()
+    if count > IMPORT_BATCH_SIZE:
+        # 未コミット分はチェックポイントできないので、大量取り込みのコミット後に1回だけ行う
+        conn.execute("PRAGMA wal_checkpoint(PASSIVE)")
     return count
 
 
 def export_stocks_csv(conn: sqlite3.Connection, path: str) -> int:
     fields = ["sku", "name", "unit", "qty", "min_qty", "below_min"]
     count = 0
-    with open(path, 'w', newline='', encoding='utf-8') as f:
-        writer = csv.DictWriter(f, fieldnames=fields)
-        writer.writeheader()
-        for item, qty in list_items_with_stock(conn):
-            below = qty < item.min_qty
-            writer.writerow({
-                "sku": item.sku,
-                "name": item.name,
-                "unit": item.unit,
-                "qty": qty,
-                "min_qty": item.min_qty,
-                "below_min": str(below).lower(),
-            })
-            count += 1
+
+    def counted(rows: Iterable[tuple]) -> Iterator[tuple]:
+        nonlocal count
+        for count, row in enumerate(rows, 1):
+            yield row
+
+    with open(path, 'w', newline='', encoding='utf-8', buffering=1 << 20) as f:
+        writer = csv.writer(f)
+        writer.writerow(fields)
+        writer.writerows(counted(list_items_with_stock_for_export(conn)))
     return count
 
 # -----------------------------
@@ -291,22 +594,29 @@ def build_parser() -> argparse.ArgumentParser:
     imp = sub.add_parser("import-items", help="品目CSVをインポート")
     imp.add_argument("path")
 
+    bp = sub.add_parser("batch", help="コマンドを列挙したファイルを1接続で一括実行")
+    bp.add_argument("path")
+
     return p
 
 
-def cmd_init(args: argparse.Namespace) -> None:
-    init_db()
+def cmd_init(args: argparse.Namespace, conn: Optional[sqlite3.Connection] = None) -> None:
+    init_db(conn)
     print(f"初期化完了: {DB_PATH}")
 
 
-def cmd_add_item(args: argparse.Namespace) -> None:
-    with closing(connect()) as conn, conn:
-        item = upsert_item(conn, args.sku, args.name, args.unit, args.min_qty)
-        print(f"登録/更新しました: SKU={item.sku} 名称={item.name} 単位={item.unit} 最小在庫={item.min_qty}")
+def cmd_add_item(args: argparse.Namespace, conn: Optional[sqlite3.Connection] = None) -> None:
+    with open_conn(conn) as conn, conn:
+        try:
+            item = upsert_item(conn, args.sku, args.name, args.unit, args.min_qty)
+            print(f"登録/更新しました: SKU={item.sku} 名称={item.name} 単位={item.unit} 最小在庫={item.min_qty}")
+        except sqlite3.IntegrityError as e:
+            print(f"エラー: {e}", file=sys.stderr)
+            sys.exit(1)
 
 
-def cmd_delete_item(args: argparse.Namespace) -> None:
-    with closing(connect()) as conn, conn:
+def cmd_delete_item(args: argparse.Namespace, conn: Optional[sqlite3.Connection] = None) -> None:
+    with open_conn(conn) as conn, conn:
         ok = delete_item(conn, args.sku)
         if ok:
             print(f"削除しました: SKU={args.sku}")
@@ -314,35 +624,33 @@ def cmd_delete_item(args: argparse.Namespace) -> None:
             print(f"見つかりません: SKU={args.sku}")
 
 
-def cmd_in(args: argparse.Namespace) -> None:
-    with closing(connect()) as conn, conn:
+def cmd_in(args: argparse.Namespace, conn: Optional[sqlite3.Connection] = None) -> None:
+    with open_conn(conn) as conn, conn:
         try:
-            move_id = register_in(conn, args.sku, args.qty, args.reason, args.ref)
-            item = get_item_by_sku(conn, args.sku)
-            assert item is not None
-            qty = get_stock(conn, item)
-            print(f"入庫登録OK id={move_id} / SKU={args.sku} 現在庫={qty}")
+            conn.execute("BEGIN IMMEDIATE")
+            item = find_item(conn, args.sku)
+            move_id = register_in(conn, item, args.qty, args.reason, args.ref)
+            print(f"入庫登録OK id={move_id} / SKU={args.sku} 現在庫={item.qty}")
         except Exception as e:
             print(f"エラー: {e}", file=sys.stderr)
             sys.exit(1)
 
 
-def cmd_out(args: argparse.Namespace) -> None:
-    with closing(connect()) as conn, conn:
+def cmd_out(args: argparse.Namespace, conn: Optional[sqlite3.Connection] = None) -> None:
+    with open_conn(conn) as conn, conn:
         try:
-            move_id = register_out(conn, args.sku, args.qty, args.reason, args.ref, args.allow_negative)
-            item = get_item_by_sku(conn, args.sku)
-            assert item is not None
-            qty = get_stock(conn, item)
-            warn = " *最小在庫割れ*" if qty < item.min_qty else ""
-            print(f"出庫登録OK id={move_id} / SKU={args.sku} 現在庫={qty}{warn}")
+            conn.execute("BEGIN IMMEDIATE")
+            item = find_item(conn, args.sku)
+            move_id = register_out(conn, item, args.qty, args.reason, args.ref, args.allow_negative)
+            warn = " *最小在庫割れ*" if item.qty < item.min_qty else ""
+            print(f"出庫登録OK id={move_id} / SKU={args.sku} 現在庫={item.qty}{warn}")
         except Exception as e:
             print(f"エラー: {e}", file=sys.stderr)
             sys.exit(1)
 
 
-def cmd_stock(args: argparse.Namespace) -> None:
-    with closing(connect()) as conn:
+def cmd_stock(args: argparse.Namespace, conn: Optional[sqlite3.Connection] = None) -> None:
+    with open_conn(conn) as conn:
         item = get_item_by_sku(conn, args.sku)
         if not item:
             print(f"SKUが見つかりません: {args.sku}", file=sys.stderr)
@@ -351,34 +659,33 @@ def cmd_stock(args: argparse.Namespace) -> None:
         print(f"SKU={item.sku} 名称={item.name} 現在庫={qty} {item.unit} (最小在庫={item.min_qty})")
 
 
-def cmd_list(args: argparse.Namespace) -> None:
-    with closing(connect()) as conn:
+def cmd_list(args: argparse.Namespace, conn: Optional[sqlite3.Connection] = None) -> None:
+    with open_conn(conn) as conn:
         print("SKU, 名称, 現在庫, 単位, 最小在庫, 注意")
         for item, qty in list_items_with_stock(conn):
             alert = "LOW" if qty < item.min_qty else ""
             print(f"{item.sku}, {item.name}, {qty}, {item.unit}, {item.min_qty}, {alert}")
 
 
-def cmd_history(args: argparse.Namespace) -> None:
-    with closing(connect()) as conn:
-        item = get_item_by_sku(conn, args.sku)
-        if not item:
+def cmd_history(args: argparse.Namespace, conn: Optional[sqlite3.Connection] = None) -> None:
+    with open_conn(conn) as conn:
+        name, rows = history_by_sku(conn, args.sku, args.limit)
+        if name is None:
             print(f"SKUが見つかりません: {args.sku}", file=sys.stderr)
             sys.exit(1)
-        print(f"履歴 (最新 {args.limit} 件): SKU={item.sku} {item.name}")
-        for r in iter_history(conn, item, args.limit):
-            sign = "+" if r["change_qty"] >= 0 else ""
-            print(f"{r['at']}  {sign}{r['change_qty']}	{r['reason'] or ''}	{r['ref'] or ''}")
+        print(f"履歴 (最新 {args.limit} 件): SKU={args.sku} {name}")
+        for r in rows:
+            print(f"{r['at']}  {r['change_qty']:+d}\t{r['reason'] or ''}\t{r['ref'] or ''}")
 
 
-def cmd_export(args: argparse.Namespace) -> None:
-    with closing(connect()) as conn:
+def cmd_export(args: argparse.Namespace, conn: Optional[sqlite3.Connection] = None) -> None:
+    with open_conn(conn) as conn:
         count = export_stocks_csv(conn, args.path)
         print(f"エクスポート完了: {args.path} (件数={count})")
 
 
-def cmd_import(args: argparse.Namespace) -> None:
-    with closing(connect()) as conn:
+def cmd_import(args: argparse.Namespace, conn: Optional[sqlite3.Connection] = None) -> None:
+    with open_conn(conn) as conn:
         try:
             count = import_items_csv(conn, args.path)
             print(f"インポート完了: {args.path} (登録/更新 {count} 件)")
@@ -387,6 +694,44 @@ def cmd_import(args: argparse.Namespace) -> None:
             sys.exit(1)
 
 
+def run_batch(conn: sqlite3.Connection, lines: Iterable[str]) -> int:
+    """各行を CLI 引数として解釈し、同じ接続で順に実行する。実行件数を返す
+
+    失敗した行があれば、行番号と内容を添えた ValueError で中断する (それまでの行はコミット済み)。
+    """
+    parser = build_parser()
+    count = 0
+    for lineno, line in enumerate(lines, 1):
+        try:
+            argv = shlex.split(line, comments=True)
+            if not argv:
+                continue
+            args = parser.parse_args(argv)
+            if args.cmd == "batch":
+                raise ValueError("バッチファイル内で batch は実行できません")
+            CMD_TABLE[args.cmd](args, conn)
+        except SystemExit as e:
+            # argparse の --help など正常終了はそのまま次の行へ
+            if not e.code:
+                continue
+            raise ValueError(f"{lineno}行目で中断しました: {line.strip()}") from e
+        except Exception as e:
+            raise ValueError(f"{lineno}行目で中断しました: {line.strip()} ({e})") from e
+        count += 1
+    return count
+
+
+def cmd_batch(args: argparse.Namespace, conn: Optional[sqlite3.Connection] = None) -> None:
+    with open_conn(conn) as conn:
+        try:
+            with open(args.path, encoding='utf-8') as f:
+                count = run_batch(conn, f)
+            print(f"バッチ完了: {args.path} (実行 {count} 件)")
+        except Exception as e:
+            print(f"エラー: {e}", file=sys.stderr)
+            sys.exit(1)
+
+
 CMD_TABLE = {
     "init": cmd_init,
     "add-item": cmd_add_item,
@@ -398,6 +743,7 @@ CMD_TABLE = {
     "history": cmd_history,
     "export-csv": cmd_export,
     "import-items": cmd_import,
+    "batch": cmd_batch,
 }
 
 
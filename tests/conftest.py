@@ -0,0 +1,40 @@
+import importlib
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import inventory_cli  # noqa: E402
+
+
+@pytest.fixture
+def db_path(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    """テストごとに専用DBへ切り替える (DB_PATH はインポート時に決まるので再読込する)"""
+    path = tmp_path / "test.db"
+    monkeypatch.setenv("INVENTORY_DB", str(path))
+    importlib.reload(inventory_cli)
+    return path
+
+
+@pytest.fixture
+def run(db_path: Path, capsys: pytest.CaptureFixture):
+    """CLI をプロセス内で実行し (終了コード, stdout, stderr) を返す"""
+    def _run(*args):
+        try:
+            code = inventory_cli.main(list(args))
+        except SystemExit as e:
+            code = e.code
+        out, err = capsys.readouterr()
+        return code, out, err
+    return _run
+
+
+@pytest.fixture
+def conn(tmp_path: Path):
+    """初期化済みDBへの接続。DAL関数を直接呼ぶテスト用"""
+    conn = inventory_cli.connect(str(tmp_path / "t.db"), check_same_thread=False)
+    inventory_cli.init_db(conn)
+    yield conn
+    conn.close()
@@ -4,10 +4,11 @@ import sys
 from pathlib import Path
 
 PY = sys.executable
+SCRIPT = str(Path(__file__).resolve().parent.parent / "inventory_cli.py")
 
 def run(*args, env=None):
-    """inventory_cli.py をサブプロセスで実行し、失敗なら詳細付きで失敗させる"""
-    result = subprocess.run([PY, "inventory_cli.py", *args],
+    """inventory_cli.py をサブプロセスで実行し、失敗なら詳細付きで失敗させる (E2Eスモークテスト用)"""
+    result = subprocess.run([PY, SCRIPT, *args],
                             text=True, capture_output=True, env=env)
     if result.returncode != 0:
         raise AssertionError(
@@ -1,68 +1,374 @@
-import os
-import subprocess
-import sys
+import csv
+import io
 import re
-
+import sqlite3
+import tempfile
+from contextlib import closing
 from pathlib import Path
-PY = sys.executable
-
-def run_ok(*args, env=None):
-    r = subprocess.run([PY, "inventory_cli.py", *args],
-                       text=True, capture_output=True, env=env)
-    assert r.returncode == 0, f"failed: {args}\nstdout={r.stdout}\nstderr={r.stderr}"
-    return r.stdout
-
-def run_ng(*args, env=None):
-    r = subprocess.run([PY, "inventory_cli.py", *args],
-                       text=True, capture_output=True, env=env)
-    assert r.returncode != 0, f"should fail: {args}"
-    return r.stderr or r.stdout
-
-def fresh_env(tmp_path: Path):
-    env = os.environ.copy()
-    env["INVENTORY_DB"] = str(tmp_path / "test.db")  # テストごとにDB分離
-    return env
-
-def test_negative_out_is_blocked(tmp_path: Path):
-    env = fresh_env(tmp_path)
-    run_ok("init", env=env)
-    run_ok("add-item", "--sku", "X-1", "--name", "テスト品", "--unit", "個", "--min-qty", "0", env=env)
-    err = run_ng("out", "--sku", "X-1", "--qty", "1", env=env)  # 在庫0で出庫→失敗
+
+import pytest
+
+import inventory_cli
+
+OLD_SCHEMA_SQL = """
+CREATE TABLE items (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, sku TEXT NOT NULL UNIQUE, name TEXT NOT NULL,
+    unit TEXT NOT NULL DEFAULT 'pcs', min_qty INTEGER NOT NULL DEFAULT 0,
+    created_at TEXT NOT NULL DEFAULT (datetime('now')),
+    updated_at TEXT NOT NULL DEFAULT (datetime('now')));
+CREATE TABLE stock_moves (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, item_id INTEGER NOT NULL, change_qty INTEGER NOT NULL,
+    reason TEXT, ref TEXT, at TEXT NOT NULL DEFAULT (datetime('now')));
+CREATE INDEX idx_items_sku ON items(sku);
+CREATE INDEX idx_moves_item_id_at ON stock_moves(item_id, at);
+INSERT INTO items (sku, name) VALUES ('M-1', '旧DB品');
+INSERT INTO items (sku, name, min_qty) VALUES ('M-2', '負の下限', -3);
+INSERT INTO stock_moves (item_id, change_qty) VALUES (1, 10), (1, -4), (1, 0);
+INSERT INTO stock_moves (item_id, change_qty) VALUES (99, 5); -- 削除済み品目の履歴
+INSERT INTO items (sku, name) VALUES ('M-9', '削除済み品目');
+DELETE FROM items WHERE sku = 'M-9';
+"""
+
+
+def make_old_db(path: Path) -> None:
+    """qty 列などのない、旧バージョンで作られたDBを用意する"""
+    with closing(sqlite3.connect(path)) as old:
+        old.executescript(OLD_SCHEMA_SQL)
+
+
+@pytest.fixture
+def run_ok(run):
+    def _run_ok(*args):
+        code, out, err = run(*args)
+        assert code == 0, f"failed: {args}\nstdout={out}\nstderr={err}"
+        return out
+    return _run_ok
+
+
+@pytest.fixture
+def run_ng(run):
+    def _run_ng(*args):
+        code, out, err = run(*args)
+        assert code != 0, f"should fail: {args}"
+        return err or out
+    return _run_ng
+
+
+def add_item(conn, sku, min_qty=0):
+    with conn:
+        return inventory_cli.upsert_item(conn, sku, "テスト品", "個", min_qty)
+
+
+def write_csv(path: Path, body: str) -> str:
+    path.write_text("sku,name,unit,min_qty\n" + body, encoding="utf-8")
+    return str(path)
+
+# -----------------------------
+# DAL / 業務ロジック
+# -----------------------------
+
+def test_connection_pragmas(conn):
+    assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    assert conn.execute("PRAGMA synchronous").fetchone()[0] == 1  # NORMAL
+    assert conn.execute("PRAGMA foreign_keys").fetchone()[0] == 1
+
+def test_negative_out_is_blocked(conn):
+    item = add_item(conn, "X-1")
+    with pytest.raises(ValueError, match="在庫不足"):  # 在庫0で出庫→失敗
+        inventory_cli.register_out(conn, item, 1)
+
+def test_allow_negative_flag(conn):
+    item = add_item(conn, "X-2")
+    with conn:
+        inventory_cli.register_out(conn, item, 2, allow_negative=True)  # 許可ならOK
+    assert inventory_cli.get_stock(conn, item) == -2
+
+def test_moves_keep_item_qty_in_sync(conn):
+    item = add_item(conn, "Q-1", min_qty=5)
+    with conn:
+        inventory_cli.register_in(conn, item, 7)
+        inventory_cli.register_out(conn, item, 3)
+    assert item.qty == 4
+    assert inventory_cli.get_stock(conn, item) == 4
+    assert inventory_cli.get_item_by_sku(conn, "Q-1").qty == 4
+
+def test_csv_import_updates_existing(conn, tmp_path: Path):
+    path = write_csv(tmp_path / "items.csv", "U-1,旧名称,箱,2\nU-2,別品,個,0\n")
+    assert inventory_cli.import_items_csv(conn, path) == 2
+    path = write_csv(tmp_path / "items.csv", "U-1, 新名称 ,,7\n")
+    assert inventory_cli.import_items_csv(conn, path) == 1
+    item = inventory_cli.get_item_by_sku(conn, "U-1")
+    assert (item.name, item.unit, item.min_qty) == ("新名称", "pcs", 7)
+
+def test_csv_import_in_batches_is_atomic(conn, tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(inventory_cli, "IMPORT_BATCH_SIZE", 2)
+    path = write_csv(tmp_path / "items.csv", "".join(f"K-{i},品{i},個,{i}\n" for i in range(5)))
+    assert inventory_cli.import_items_csv(conn, path) == 5
+    assert inventory_cli.get_item_by_sku(conn, "K-4").min_qty == 4
+
+    path = write_csv(tmp_path / "items.csv", "N-1,a,個,1\nN-2,b,個,1\nN-3,c,個,x\n")
+    with pytest.raises(ValueError, match="min_qty"):
+        inventory_cli.import_items_csv(conn, path)
+    assert inventory_cli.get_item_by_sku(conn, "N-1") is None  # 途中のバッチも巻き戻る
+
+def test_history_by_sku(conn):
+    item = add_item(conn, "H-1")
+    add_item(conn, "H-0")
+    with conn:
+        inventory_cli.register_in(conn, item, 3)
+        inventory_cli.register_out(conn, item, 1)
+    name, rows = inventory_cli.history_by_sku(conn, "H-1", 5)
+    assert name == "テスト品" and [r["change_qty"] for r in rows] == [-1, 3]
+    assert inventory_cli.history_by_sku(conn, "H-0") == ("テスト品", [])
+    assert inventory_cli.history_by_sku(conn, "H-404") == (None, [])
+
+def test_history_uses_covering_index(conn):
+    plan = " ".join(r[3] for r in conn.execute("EXPLAIN QUERY PLAN " + inventory_cli.HISTORY_BY_SKU_SQL, ("X", 5)))
+    assert "SEARCH m USING COVERING INDEX idx_moves_hist" in plan and "TEMP B-TREE" not in plan
+
+def test_connect_migrates_old_schema(tmp_path: Path):
+    path = tmp_path / "old.db"
+    make_old_db(path)
+    conn = inventory_cli.connect(str(path))
+    try:
+        assert inventory_cli.get_item_by_sku(conn, "M-1").qty == 6  # qty 列を追加して集計値で埋める
+        names = {r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+        assert not names & {"idx_items_sku", "idx_moves_item_id_at"}
+        plan = " ".join(r[3] for r in conn.execute("EXPLAIN QUERY PLAN " + inventory_cli.GET_ITEM_BY_SKU_SQL, ("X",)))
+        assert "sqlite_autoindex_items_1" in plan
+        # CHECK 制約つきで作り直し、制約に反する行は直すか捨てる
+        assert not inventory_cli.needs_rebuild(conn)
+        # 削除済みの id (items=3, stock_moves=4) は再発行しない
+        with conn:
+            item = inventory_cli.upsert_item(conn, "M-4", "移行後の品目", "個", 0)
+            move_id = inventory_cli.register_in(conn, item, 1)
+        assert (item.id, move_id) == (4, 5)
+        assert inventory_cli.get_item_by_sku(conn, "M-2").min_qty == 0
+        assert conn.execute("SELECT COUNT(*) FROM stock_moves WHERE item_id <> ?", (item.id,)).fetchone()[0] == 2
+        with pytest.raises(sqlite3.IntegrityError), conn:
+            inventory_cli.upsert_item(conn, "M-3", "負の下限", "個", -1)
+        with pytest.raises(sqlite3.IntegrityError), conn:
+            conn.execute("INSERT INTO stock_moves (item_id, change_qty) VALUES (1, 0)")
+        with conn:
+            inventory_cli.delete_item(conn, "M-1")
+        assert conn.execute("SELECT COUNT(*) FROM stock_moves WHERE item_id = 1").fetchone()[0] == 0  # 外部キーも有効
+    finally:
+        conn.close()
+
+def test_check_constraints_reject_invalid_rows(conn, tmp_path: Path):
+    item = add_item(conn, "C-1")
+    with pytest.raises(sqlite3.IntegrityError), conn:
+        conn.execute("INSERT INTO stock_moves (item_id, change_qty) VALUES (?, 0)", (item.id,))
+    with pytest.raises(sqlite3.IntegrityError), conn:
+        inventory_cli.upsert_item(conn, "C-2", "負の下限", "個", -1)
+    path = write_csv(tmp_path / "items.csv", "C-3,a,個,1\nC-4,b,個,-5\n")
+    with pytest.raises(sqlite3.IntegrityError):
+        inventory_cli.import_items_csv(conn, path)
+    assert inventory_cli.get_item_by_sku(conn, "C-3") is None
+
+@pytest.mark.parametrize("has_returning", [True, False])
+def test_upsert_item_returns_current_row(conn, monkeypatch: pytest.MonkeyPatch, has_returning: bool):
+    monkeypatch.setattr(inventory_cli, "HAS_RETURNING", has_returning)
+    item = add_item(conn, "R-1", min_qty=1)
+    with conn:
+        inventory_cli.register_in(conn, item, 4)
+        updated = inventory_cli.upsert_item(conn, "R-1", "更新後", "箱", 2)
+    assert updated == inventory_cli.Item(item.id, "R-1", "更新後", "箱", 2, 4)
+
+def test_delete_item_leaves_commit_to_caller(conn):
+    item = add_item(conn, "D-1")
+    with conn:
+        inventory_cli.register_in(conn, item, 2)
+    assert inventory_cli.delete_item(conn, "D-1")
+    conn.rollback()
+    assert inventory_cli.get_item_by_sku(conn, "D-1") is not None
+    with conn:
+        assert inventory_cli.delete_item(conn, "D-1")
+    assert inventory_cli.get_item_by_sku(conn, "D-1") is None
+    assert conn.execute("SELECT COUNT(*) FROM stock_moves").fetchone()[0] == 0  # 履歴も連鎖削除
+    assert not inventory_cli.delete_item(conn, "D-1")
+
+def load_csv_table(conn, text: str) -> None:
+    """csv 拡張の代わりに、同じ内容の temp.csv_in を普通の一時表として用意する"""
+    header, *rows = csv.reader(io.StringIO(text))
+    conn.execute(f"CREATE TEMP TABLE csv_in ({', '.join(header)})")
+    conn.executemany(
+        f"INSERT INTO temp.csv_in VALUES ({', '.join('?' * len(header))})",
+        [(r + [None] * len(header))[:len(header)] for r in rows],
+    )
+    conn.commit()
+
+
+def import_both_ways(tmp_path: Path, text: str):
+    """Python 版と SQL (csv 仮想テーブル) 版で同じCSVを取り込み、(件数または例外, 品目) を返す
+
+    SQL 版が None を返したときは import_items_csv と同じく Python 版に切り替える。
+    """
+    work = Path(tempfile.mkdtemp(dir=tmp_path))  # 呼び出しごとに空のDBを使う
+    path = work / "items.csv"
+    path.write_text(text, encoding="utf-8")
+    results = []
+    for name in ("python", "native"):
+        conn = inventory_cli.connect(str(work / f"{name}.db"))
+        try:
+            inventory_cli.init_db(conn)
+            try:
+                if name == "python":
+                    outcome = inventory_cli.import_items_csv_python(conn, str(path))
+                else:
+                    load_csv_table(conn, text)
+                    outcome = inventory_cli.import_items_from_csv_table(conn)
+                    if outcome is None:
+                        outcome = inventory_cli.import_items_csv_python(conn, str(path))
+            except ValueError as e:
+                outcome = str(e)
+            items = [tuple(r) for r in conn.execute("SELECT sku, name, unit, min_qty FROM items ORDER BY sku")]
+            results.append((outcome, items))
+        finally:
+            conn.close()
+    return results
+
+
+@pytest.mark.parametrize("text", [
+    "sku,name,unit,min_qty\n A-1 ,\tネジ\u3000,, +5\nB-2,板,枚,\n,,,\nA-1,ネジ2,袋,\t3\n",
+    "sku,name,unit,min_qty,memo\nC-1,余分な列,個,007,x\n",
+    "sku,name,unit,min_qty\nZ-1,全角,個,５\nU-1,区切り,個,1_000\n",
+    "sku,name,unit,min_qty\nA-1,a,個,\u2003\nB-2,b,個,99999999999999999999\n",
+    "sku,name,unit,min_qty\nA-1,a,個,1.5\n",
+    "sku,name,unit,min_qty\nA-1,a,個,-\n",
+    "sku,name,unit,min_qty\nA-1,a,個,1\n ,名無し,個,1\nB-2,b,個,x\n",
+    "sku,name,min_qty\nA-1,a,1\n",
+])
+def test_native_csv_import_matches_python(tmp_path: Path, text: str):
+    python_result, native_result = import_both_ways(tmp_path, text)
+    assert native_result == python_result
+
+
+def test_csv_import_rules(tmp_path: Path):
+    (count, items), _ = import_both_ways(
+        tmp_path, "sku,name,unit,min_qty\n A-1 ,\tネジ\u3000,, +5\nB-2,板,枚,\nA-1,ネジ2,袋,\t3\n")
+    assert count == 3 and items == [("A-1", "ネジ2", "袋", 3), ("B-2", "板", "枚", 0)]
+    (error, items), _ = import_both_ways(tmp_path, "sku,name,unit,min_qty\nA-1,a,個,1\nB-2,b,個,1.5\n")
+    assert error == "min_qty が整数ではありません (sku=B-2): 1.5" and items == []
+
+
+def test_csv_import_accepts_int_literals(conn, tmp_path: Path):
+    # 全角数字や桁区切りの _ は int() が受け付けるので、SQL 版は Python 版に任せる
+    text = "sku,name,unit,min_qty\nZ-1,全角,個,５\nU-1,区切り,個,1_000\n"
+    load_csv_table(conn, text)
+    assert inventory_cli.import_items_from_csv_table(conn) is None
+    assert conn.execute("SELECT COUNT(*) FROM items").fetchone()[0] == 0
+    path = write_csv(tmp_path / "items.csv", "Z-1,全角,個,５\nU-1,区切り,個,1_000\n")
+    assert inventory_cli.import_items_csv_python(conn, path) == 2
+    assert inventory_cli.get_item_by_sku(conn, "Z-1").min_qty == 5
+    assert inventory_cli.get_item_by_sku(conn, "U-1").min_qty == 1000
+
+
+def test_csv_whitespace_matches_str_strip():
+    assert set(inventory_cli.CSV_WHITESPACE) == {chr(c) for c in range(0x3001) if chr(c).isspace()}
+
+
+def test_csv_import_falls_back_without_extension(conn, tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(inventory_cli, "CSV_EXTENSION", str(tmp_path / "no_such_extension"))
+    assert inventory_cli.load_csv_extension(conn) is False
+
+    def native(conn, path):
+        raise AssertionError("csv 拡張なしで SQL 版が呼ばれた")
+    monkeypatch.setattr(inventory_cli, "import_items_csv_native", native)
+    path = write_csv(tmp_path / "items.csv", "F-1,代替,個,1\n")
+    assert inventory_cli.import_items_csv(conn, path) == 1
+    assert inventory_cli.get_item_by_sku(conn, "F-1").name == "代替"
+
+# -----------------------------
+# CLI 出力
+# -----------------------------
+
+def test_negative_out_reports_error(run_ok, run_ng):
+    run_ok("init")
+    run_ok("add-item", "--sku", "X-1", "--name", "テスト品", "--unit", "個", "--min-qty", "0")
+    err = run_ng("out", "--sku", "X-1", "--qty", "1")
     assert "在庫不足" in err
 
-def test_allow_negative_flag(tmp_path: Path):
-    env = fresh_env(tmp_path)
-    run_ok("init", env=env)
-    run_ok("add-item", "--sku", "X-2", "--name", "テスト品", "--unit", "個", "--min-qty", "0", env=env)
-    run_ok("out", "--sku", "X-2", "--qty", "2", "--allow-negative", env=env)  # 許可ならOK
-    out = run_ok("stock", "--sku", "X-2", env=env)
-    assert "現在庫=-2" in out
-
-def test_min_qty_alert_on_list(tmp_path: Path):
-    env = fresh_env(tmp_path)
-    run_ok("init", env=env)
-    run_ok("add-item", "--sku", "A-LOW", "--name", "下限テスト", "--unit", "袋", "--min-qty", "10", env=env)
-    run_ok("in", "--sku", "A-LOW", "--qty", "5", env=env)  # 下限未満
-    listing = run_ok("list", env=env)
+def test_min_qty_alert_on_list(run_ok):
+    run_ok("init")
+    run_ok("add-item", "--sku", "A-LOW", "--name", "下限テスト", "--unit", "袋", "--min-qty", "10")
+    run_ok("in", "--sku", "A-LOW", "--qty", "5")  # 下限未満
+    listing = run_ok("list")
     assert re.search(r"A-LOW.*LOW", listing)  # LOW表示
 
-def test_history_order_and_sign(tmp_path: Path):
-    env = fresh_env(tmp_path)
-    run_ok("init", env=env)
-    run_ok("add-item", "--sku", "H-1", "--name", "履歴品", "--unit", "個", "--min-qty", "0", env=env)
-    run_ok("in",  "--sku", "H-1", "--qty", "3", env=env)
-    run_ok("out", "--sku", "H-1", "--qty", "1", env=env)
-    hist = run_ok("history", "--sku", "H-1", "--limit", "5", env=env)
+def test_history_order_and_sign(run_ok):
+    run_ok("init")
+    run_ok("add-item", "--sku", "H-1", "--name", "履歴品", "--unit", "個", "--min-qty", "0")
+    run_ok("in",  "--sku", "H-1", "--qty", "3")
+    run_ok("out", "--sku", "H-1", "--qty", "1")
+    hist = run_ok("history", "--sku", "H-1", "--limit", "5")
     assert "-1" in hist and "+3" in hist
 
-def test_csv_export_and_import(tmp_path: Path):
-    env = fresh_env(tmp_path)
-    run_ok("init", env=env)
-    items_csv = tmp_path / "items.csv"
-    items_csv.write_text("sku,name,unit,min_qty\nC-1,CSV品,箱,2\n", encoding="utf-8")
-    run_ok("import-items", str(items_csv), env=env)
-    run_ok("in", "--sku", "C-1", "--qty", "5", env=env)
+def test_history_header_without_moves_and_unknown_sku(run_ok, run_ng):
+    run_ok("init")
+    run_ok("add-item", "--sku", "H-0", "--name", "履歴なし品")
+    out = run_ok("history", "--sku", "H-0")
+    assert out.splitlines() == ["履歴 (最新 50 件): SKU=H-0 履歴なし品"]
+    assert "SKUが見つかりません" in run_ng("history", "--sku", "H-404")
+
+def test_commands_work_on_old_db_without_init(run_ok, run_ng, db_path: Path):
+    make_old_db(db_path)
+    assert "現在庫=6" in run_ok("stock", "--sku", "M-1")
+    assert "M-1, 旧DB品, 6" in run_ok("list")
+    assert "-4" in run_ok("history", "--sku", "M-1")
+    assert "現在庫=7" in run_ok("in", "--sku", "M-1", "--qty", "1")
+    assert "CHECK constraint failed" in run_ng("add-item", "--sku", "M-1", "--name", "x", "--min-qty", "-1")
+
+def test_in_out_report_current_stock(run_ok, run_ng):
+    run_ok("init")
+    run_ok("add-item", "--sku", "Q-1", "--name", "数量品", "--unit", "個", "--min-qty", "5")
+    out = run_ok("in", "--sku", "Q-1", "--qty", "7")
+    assert "現在庫=7" in out
+    out = run_ok("out", "--sku", "Q-1", "--qty", "3")
+    assert "現在庫=4" in out and "最小在庫割れ" in out
+    err = run_ng("in", "--sku", "NOPE", "--qty", "1")
+    assert "SKUが存在しません" in err
+
+def test_csv_export_and_import(run_ok, tmp_path: Path):
+    run_ok("init")
+    items_csv = write_csv(tmp_path / "items.csv", "C-1,CSV品,箱,2\nD-1,在庫なし品,個,3\n")
+    assert "2 件" in run_ok("import-items", items_csv)
+    run_ok("in", "--sku", "C-1", "--qty", "5")
     out_csv = tmp_path / "stocks.csv"
-    run_ok("export-csv", str(out_csv), env=env)
+    assert "件数=2" in run_ok("export-csv", str(out_csv))
     data = out_csv.read_text(encoding="utf-8")
-    assert "C-1" in data and "false" in data  # 5>=2 → below_min=false
+    assert data.splitlines() == [
+        "sku,name,unit,qty,min_qty,below_min",
+        "C-1,CSV品,箱,5,2,false",  # 5>=2 → below_min=false
+        "D-1,在庫なし品,個,0,3,true",
+    ]
+
+def test_batch_runs_commands_on_one_connection(run_ok, run_ng, tmp_path: Path):
+    batch = tmp_path / "cmds.txt"
+    batch.write_text(
+        "# コメント行\n"
+        "init\n"
+        "add-item --sku B-1 --name 'バッチ 品' --unit 個 --min-qty 1\n"
+        "\n"
+        "in --sku B-1 --qty 5\n"
+        "out --sku B-1 --qty 2  # 出荷\n",
+        encoding="utf-8",
+    )
+    out = run_ok("batch", str(batch))
+    assert "実行 4 件" in out
+    out = run_ok("stock", "--sku", "B-1")
+    assert "バッチ 品" in out and "現在庫=3" in out
+
+    batch.write_text("out --sku B-1 --qty 99\nin --sku B-1 --qty 1\n", encoding="utf-8")
+    err = run_ng("batch", str(batch))
+    assert "在庫不足" in err and "1行目で中断しました: out --sku B-1 --qty 99" in err
+    assert "現在庫=3" in run_ok("stock", "--sku", "B-1")  # 失敗行で中断
+
+def test_batch_reports_bad_line_in_the_middle(run_ok, run_ng, tmp_path: Path):
+    run_ok("init")
+    run_ok("add-item", "--sku", "B-2", "--name", "バッチ品")
+    batch = tmp_path / "cmds.txt"
+    batch.write_text("in --sku B-2 --qty 1\nbogus --x\nin --sku B-2 --qty 10\n", encoding="utf-8")
+    err = run_ng("batch", str(batch))
+    assert "2行目で中断しました: bogus --x" in err
+    assert "現在庫=1" in run_ok("stock", "--sku", "B-2")  # 前の行は反映済み、後の行は未実行